@@ -5,6 +5,11 @@ import plotly.graph_objects as go
 import urllib.parse
 from sqlalchemy import create_engine
 
+try:
+    import connectorx as cx
+except ImportError:
+    cx = None
+
 # Configuração da página
 st.set_page_config(
     page_title="Análise de Critérios Avaliativos",
@@ -18,117 +23,311 @@ st.title("📊 Análise Detalhada de Critérios Avaliativos")
 database_url = st.secrets["DB_URL"]
 @st.cache_resource
 def get_connection():
-    # Usar diretamente a URL completa
-    return create_engine(database_url)
+    # Pool enxuto para um dashboard de poucos usuários: pre_ping evita
+    # reutilizar conexões mortas depois de idle e o statement_timeout
+    # corta consultas desgovernadas antes de travarem a interface
+    return create_engine(
+        database_url,
+        pool_size=4,
+        max_overflow=4,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+        connect_args={'options': '-c statement_timeout=30000'}
+    )
 
 
-# Função para executar consultas
+# Função para executar consultas. Falhas propagam como exceção: o
+# st.cache_data dos loaders não memoriza exceções, então uma falha
+# transitória é retentada no próximo rerun em vez de ficar cacheada
 def executar_consulta(query):
     try:
+        if cx is not None:
+            # connectorx lê o protocolo binário do Postgres em Rust,
+            # multi-thread, direto para colunas — sem conversão linha
+            # a linha via DBAPI
+            return cx.read_sql(database_url, query, return_type="pandas")
         conn = get_connection()
         return pd.read_sql(query, conn)
     except Exception as e:
-        st.error(f"Erro ao executar consulta: {e}")
-        st.code(query)  # Mostra a consulta com erro para depuração
+        # Inclui a consulta na mensagem para depuração
+        raise RuntimeError(f"Erro ao executar consulta: {e}\n\n{query}") from e
+
+# Função para chamar um loader cacheado tratando a falha no ponto de uso:
+# exibe o erro e devolve None, como no contrato original das consultas
+def tentar_carregar(loader, *args):
+    try:
+        return loader(*args)
+    except Exception as e:
+        st.error(str(e))
         return None
 
-# Função para carregar dados detalhados das categorias específicas
-def carregar_dados_categorias():
-    query = """
-    SELECT 
+# Trechos de SQL compartilhados pelos loaders, para que as CTEs de
+# contagem não divirjam entre as consultas.
+# ca_flags calcula cada predicado booleano uma única vez por linha,
+# reutilizado pelos agregados com FILTER
+SQL_CA_FLAGS = """ca_flags AS (
+        SELECT
+            entidade_id,
+            (formula_personalizada IS NOT NULL) AS is_formula,
+            (criterio_calculo_grupo_id IS NOT NULL AND possui_criterios_grupos) AS is_grupo,
+            possui_recuperacao_paralela AS rec_paralela,
+            possui_recuperacao_semestral AS rec_semestral
+        FROM criterios_avaliativos
+    )"""
+
+SQL_CRIT_CATEGORIAS = """crit AS (
+        SELECT
+            entidade_id,
+            COUNT(*) AS total_criterios,
+            COUNT(*) FILTER (WHERE is_formula) AS formula_personalizada,
+            COUNT(*) FILTER (WHERE is_grupo) AS criterio_grupo,
+            COUNT(*) FILTER (WHERE is_grupo AND rec_paralela) AS grupo_rec_paralela,
+            COUNT(*) FILTER (WHERE is_grupo AND rec_semestral) AS grupo_rec_semestral,
+            COUNT(*) FILTER (WHERE is_formula AND rec_paralela) AS formula_rec_paralela,
+            COUNT(*) FILTER (WHERE is_formula AND rec_semestral) AS formula_rec_semestral
+        FROM ca_flags
+        GROUP BY entidade_id
+    )"""
+
+SQL_CRIT_CONTAGEM = """crit AS (
+        SELECT entidade_id, COUNT(*) AS total_criterios
+        FROM criterios_avaliativos
+        GROUP BY entidade_id
+    )"""
+
+SQL_TC = """tc AS (
+        SELECT entidade_id, COUNT(*) AS total_turmas
+        FROM turmas
+        GROUP BY entidade_id
+    )"""
+
+SQL_MC = """mc AS (
+        SELECT t.entidade_id, COUNT(*) AS total_matriculas
+        FROM matriculas m
+        JOIN turmas t ON m.turma_id = t.id
+        GROUP BY t.entidade_id
+    )"""
+
+# Função para montar o filtro de entidades embutido nas consultas.
+# connectorx não aceita parâmetros vinculados; como os ids são inteiros
+# vindos do banco, int() garante literais seguros
+def montar_filtro_entidades(entidade_ids, coluna='e.id'):
+    if not entidade_ids:
+        return ""
+    ids_sql = ", ".join(str(int(i)) for i in entidade_ids)
+    return f"AND {coluna} IN ({ids_sql})"
+
+# Função para carregar os dados detalhados por entidade: categorias de
+# critérios e matrículas/turmas em uma única consulta, já no formato final.
+# Os filtros da interface são aplicados direto no banco; o cache é
+# indexado pelos valores dos filtros
+@st.cache_data(ttl=3600, show_spinner=False)
+def carregar_dados_completos(min_matriculas=0, min_criterios=1, entidade_ids=None):
+    filtro_entidades = montar_filtro_entidades(entidade_ids)
+    query = f"""
+    WITH {SQL_CA_FLAGS},
+    {SQL_CRIT_CATEGORIAS},
+    {SQL_TC},
+    {SQL_MC}
+    SELECT
         e.id AS entidade_id,
         e.nome AS nome_entidade,
-        
-        -- Total de critérios
-        COUNT(DISTINCT ca.id) AS total_criterios,
-        
-        -- Critérios com fórmula personalizada
-        SUM(CASE WHEN ca.formula_personalizada IS NOT NULL THEN 1 ELSE 0 END) AS formula_personalizada,
-        
-        -- Critérios de grupo
-        SUM(CASE WHEN ca.criterio_calculo_grupo_id IS NOT NULL AND ca.possui_criterios_grupos = true THEN 1 ELSE 0 END) AS criterio_grupo,
-        
-        -- Critérios de grupo com recuperação paralela
-        SUM(CASE WHEN ca.criterio_calculo_grupo_id IS NOT NULL 
-                  AND ca.possui_criterios_grupos = true 
-                  AND ca.possui_recuperacao_paralela = true THEN 1 ELSE 0 END) AS grupo_rec_paralela,
-        
-        -- Critérios de grupo com recuperação semestral
-        SUM(CASE WHEN ca.criterio_calculo_grupo_id IS NOT NULL 
-                  AND ca.possui_criterios_grupos = true 
-                  AND ca.possui_recuperacao_semestral = true THEN 1 ELSE 0 END) AS grupo_rec_semestral,
-        
-        -- Critérios com fórmula personalizada com recuperação paralela
-        SUM(CASE WHEN ca.formula_personalizada IS NOT NULL 
-                  AND ca.possui_recuperacao_paralela = true THEN 1 ELSE 0 END) AS formula_rec_paralela,
-        
-        -- Critérios com fórmula personalizada com recuperação semestral
-        SUM(CASE WHEN ca.formula_personalizada IS NOT NULL 
-                  AND ca.possui_recuperacao_semestral = true THEN 1 ELSE 0 END) AS formula_rec_semestral
-        
-    FROM 
+        crit.total_criterios,
+        crit.formula_personalizada,
+        crit.criterio_grupo,
+        crit.grupo_rec_paralela,
+        crit.grupo_rec_semestral,
+        crit.formula_rec_paralela,
+        crit.formula_rec_semestral,
+        ROUND(100.0 * crit.formula_personalizada / NULLIF(crit.total_criterios, 0), 1) AS percentual_formula,
+        ROUND(100.0 * crit.criterio_grupo / NULLIF(crit.total_criterios, 0), 1) AS percentual_grupo,
+        COALESCE(mc.total_matriculas, 0) AS total_matriculas,
+        COALESCE(tc.total_turmas, 0) AS total_turmas
+    FROM
         entidades e
-    LEFT JOIN 
-        criterios_avaliativos ca ON ca.entidade_id = e.id
-    GROUP BY 
-        e.id, e.nome
-    HAVING 
-        COUNT(DISTINCT ca.id) > 0
-    ORDER BY 
+    JOIN
+        crit ON crit.entidade_id = e.id
+    LEFT JOIN
+        tc ON tc.entidade_id = e.id
+    LEFT JOIN
+        mc ON mc.entidade_id = e.id
+    WHERE
+        crit.total_criterios >= {int(min_criterios)}
+        AND COALESCE(mc.total_matriculas, 0) >= {int(min_matriculas)}
+        {filtro_entidades}
+    ORDER BY
         total_criterios DESC
     """
+    df = executar_consulta(query)
+    # Reduzir as colunas de contagem de int64 para int32: metade da
+    # memória e metade dos bytes em cada cópia e figura serializada
+    colunas_int = [
+        'total_criterios', 'formula_personalizada', 'criterio_grupo',
+        'grupo_rec_paralela', 'grupo_rec_semestral',
+        'formula_rec_paralela', 'formula_rec_semestral',
+        'total_matriculas', 'total_turmas'
+    ]
+    df[colunas_int] = df[colunas_int].astype('int32')
+    return df
+
+# Função para carregar os totais gerais já agregados no banco,
+# aplicando os mesmos filtros usados na interface
+@st.cache_data(ttl=3600, show_spinner=False)
+def carregar_totais(min_matriculas, min_criterios, entidade_ids):
+    filtro_entidades = montar_filtro_entidades(entidade_ids, coluna='crit.entidade_id')
+    query = f"""
+    WITH {SQL_CA_FLAGS},
+    {SQL_CRIT_CATEGORIAS},
+    {SQL_TC},
+    {SQL_MC}
+    SELECT
+        COALESCE(SUM(crit.total_criterios), 0) AS total_criterios,
+        COALESCE(SUM(crit.formula_personalizada), 0) AS formula_personalizada,
+        COALESCE(SUM(crit.criterio_grupo), 0) AS criterio_grupo,
+        COALESCE(SUM(crit.grupo_rec_paralela), 0) AS grupo_rec_paralela,
+        COALESCE(SUM(crit.grupo_rec_semestral), 0) AS grupo_rec_semestral,
+        COALESCE(SUM(crit.formula_rec_paralela), 0) AS formula_rec_paralela,
+        COALESCE(SUM(crit.formula_rec_semestral), 0) AS formula_rec_semestral,
+        COALESCE(SUM(mc.total_matriculas), 0) AS total_matriculas,
+        COALESCE(SUM(tc.total_turmas), 0) AS total_turmas
+    FROM crit
+    LEFT JOIN tc ON tc.entidade_id = crit.entidade_id
+    LEFT JOIN mc ON mc.entidade_id = crit.entidade_id
+    WHERE crit.total_criterios >= {int(min_criterios)}
+      AND COALESCE(mc.total_matriculas, 0) >= {int(min_matriculas)}
+      {filtro_entidades}
+    """
     return executar_consulta(query)
 
-# Função para carregar dados de matrículas por entidade
-def carregar_dados_matriculas():
-    query = """
-    SELECT 
-        e.id AS entidade_id,
+# Função para carregar apenas as colunas usadas no gráfico de top
+# matrículas, já ordenadas e limitadas no banco (poda de colunas)
+@st.cache_data(ttl=3600, show_spinner=False)
+def carregar_top_matriculas(num_entidades, min_matriculas=0, min_criterios=1, entidade_ids=None):
+    filtro_entidades = montar_filtro_entidades(entidade_ids)
+    query = f"""
+    WITH {SQL_CRIT_CONTAGEM},
+    {SQL_MC}
+    SELECT
         e.nome AS nome_entidade,
-        COUNT(DISTINCT m.id) AS total_matriculas,
-        COUNT(DISTINCT t.id) AS total_turmas
-    FROM 
-        entidades e
-    LEFT JOIN 
-        turmas t ON t.entidade_id = e.id
-    LEFT JOIN 
-        matriculas m ON m.turma_id = t.id
-    GROUP BY 
-        e.id, e.nome
-    ORDER BY 
-        total_matriculas DESC
+        COALESCE(mc.total_matriculas, 0) AS total_matriculas
+    FROM entidades e
+    JOIN crit ON crit.entidade_id = e.id
+    LEFT JOIN mc ON mc.entidade_id = e.id
+    WHERE crit.total_criterios >= {int(min_criterios)}
+      AND COALESCE(mc.total_matriculas, 0) >= {int(min_matriculas)}
+      {filtro_entidades}
+    ORDER BY total_matriculas DESC
+    LIMIT {int(num_entidades)}
+    """
+    return executar_consulta(query)
+
+# Função para carregar os limites dos sliders; os máximos só mudam
+# quando os dados mudam, então a consulta fica cacheada junto das demais
+@st.cache_data(ttl=3600, show_spinner=False)
+def carregar_limites():
+    query = f"""
+    WITH {SQL_CRIT_CONTAGEM},
+    {SQL_MC}
+    SELECT
+        COALESCE(MAX(mc.total_matriculas), 0) AS max_matriculas,
+        COALESCE(MAX(crit.total_criterios), 1) AS max_criterios
+    FROM crit
+    LEFT JOIN mc ON mc.entidade_id = crit.entidade_id
     """
     return executar_consulta(query)
 
+# Função para montar os dados do gráfico de pizza a partir dos totais;
+# só é recalculada quando os totais mudam (ou seja, quando os filtros mudam)
+@st.cache_data(show_spinner=False)
+def montar_dados_pizza(totais):
+    total_criterios = int(totais['total_criterios'])
+    total_formula = int(totais['formula_personalizada'])
+    total_grupo = int(totais['criterio_grupo'])
+    total_formula_paralela = int(totais['formula_rec_paralela'])
+    total_formula_semestral = int(totais['formula_rec_semestral'])
+    total_grupo_paralela = int(totais['grupo_rec_paralela'])
+    total_grupo_semestral = int(totais['grupo_rec_semestral'])
+
+    df_pizza = pd.DataFrame({
+        'Categoria': [
+            'Fórmula Personalizada com Rec. Paralela',
+            'Fórmula Personalizada com Rec. Semestral',
+            'Fórmula Personalizada (outros)',
+            'Critério de Grupo com Rec. Paralela',
+            'Critério de Grupo com Rec. Semestral',
+            'Critério de Grupo (outros)',
+            'Outros Critérios'
+        ],
+        'Quantidade': [
+            total_formula_paralela,
+            total_formula_semestral,
+            total_formula - total_formula_paralela - total_formula_semestral,
+            total_grupo_paralela,
+            total_grupo_semestral,
+            total_grupo - total_grupo_paralela - total_grupo_semestral,
+            total_criterios - total_formula - total_grupo
+        ]
+    })
+
+    # Remover categorias com zero
+    return df_pizza[df_pizza['Quantidade'] > 0]
+
+# Função para indexar o frame filtrado por nome de entidade, permitindo
+# lookup por hash na análise por entidade em vez de varredura booleana
+@st.cache_data(show_spinner=False)
+def indexar_por_nome(df):
+    return df.set_index('nome_entidade')
+
+# Função para montar o gráfico de radar de uma entidade; cacheada por
+# (entidade, valores) para não reconstruir a figura a cada rerun
+@st.cache_data(show_spinner=False)
+def montar_radar(entidade, categorias, valores):
+    fig = go.Figure()
+
+    fig.add_trace(go.Scatterpolar(
+        r=list(valores),
+        theta=categorias,
+        fill='toself',
+        name=entidade
+    ))
+
+    fig.update_layout(
+        polar=dict(
+            radialaxis=dict(
+                visible=True,
+                range=[0, max(valores) * 1.1]
+            )
+        ),
+        title=f"Perfil de Critérios Avaliativos de {entidade}"
+    )
+
+    return fig
+
+# Função para codificar o CSV de download; cacheada para não reencodar
+# a tabela inteira a cada interação
+@st.cache_data(show_spinner=False)
+def to_csv_bytes(df):
+    return df.to_csv(index=False).encode('utf-8')
+
+# Botão para recarregar os dados do banco (limpa o cache das consultas);
+# fica fora do caminho de sucesso para permitir recuperação após falha
+if st.sidebar.button("🔄 Atualizar dados"):
+    carregar_dados_completos.clear()
+    carregar_totais.clear()
+    carregar_top_matriculas.clear()
+    carregar_limites.clear()
+    st.rerun()
+
 # Carregar dados
 with st.spinner("Carregando dados detalhados..."):
-    # Carregar categorias de critérios
-    df_categorias = carregar_dados_categorias()
-    
-    # Carregar matrículas
-    df_matriculas = carregar_dados_matriculas()
-    
-    if df_categorias is not None and df_matriculas is not None:
-        # Mesclar os dados
-        df_completo = pd.merge(
-            df_categorias,
-            df_matriculas[['entidade_id', 'total_matriculas', 'total_turmas']],
-            on='entidade_id',
-            how='left'
-        )
-        
-        # Preencher valores nulos com zeros
-        df_completo.fillna(0, inplace=True)
-        
-        # Calcular alguns campos derivados
-        df_completo['percentual_formula'] = (df_completo['formula_personalizada'] / df_completo['total_criterios'] * 100).round(1)
-        df_completo['percentual_grupo'] = (df_completo['criterio_grupo'] / df_completo['total_criterios'] * 100).round(1)
-        
+    df_completo = tentar_carregar(carregar_dados_completos)
+
+    if df_completo is not None:
         st.success(f"✅ Dados carregados com sucesso! Analisando {len(df_completo)} entidades.")
-        
+
         # Filtros na barra lateral
         st.sidebar.header("Filtros")
-        
+
         # Filtro por nome de entidade
         todas_entidades = df_completo['nome_entidade'].unique()
         entidades_selecionadas = st.sidebar.multiselect(
@@ -137,19 +336,29 @@ with st.spinner("Carregando dados detalhados..."):
             default=[]
         )
         
+        # Limites dos sliders vindos de uma consulta pequena e cacheada;
+        # se ela falhar, calcular dos dados já carregados
+        df_limites = tentar_carregar(carregar_limites)
+        if df_limites is not None:
+            max_matriculas = int(df_limites.iloc[0]['max_matriculas'])
+            max_criterios = int(df_limites.iloc[0]['max_criterios'])
+        else:
+            max_matriculas = int(df_completo['total_matriculas'].max())
+            max_criterios = int(df_completo['total_criterios'].max())
+
         # Filtro por quantidade mínima de matrículas
         min_matriculas = st.sidebar.slider(
             "Quantidade mínima de matrículas",
             min_value=0,
-            max_value=int(df_completo['total_matriculas'].max()),
+            max_value=max_matriculas,
             value=0
         )
-        
+
         # Filtro por quantidade mínima de critérios
         min_criterios = st.sidebar.slider(
             "Quantidade mínima de critérios",
             min_value=1,
-            max_value=int(df_completo['total_criterios'].max()),
+            max_value=max_criterios,
             value=1
         )
         
@@ -161,63 +370,79 @@ with st.spinner("Carregando dados detalhados..."):
             value=30
         )
         
-        # Aplicar filtros
-        df_filtrado = df_completo.copy()
-        
-        if entidades_selecionadas:
-            df_filtrado = df_filtrado[df_filtrado['nome_entidade'].isin(entidades_selecionadas)]
-        
-        df_filtrado = df_filtrado[df_filtrado['total_matriculas'] >= min_matriculas]
-        df_filtrado = df_filtrado[df_filtrado['total_criterios'] >= min_criterios]
-        
+        # Aplicar filtros direto na consulta (cacheada por combinação de filtros)
+        ids_selecionados = df_completo.loc[
+            df_completo['nome_entidade'].isin(entidades_selecionadas), 'entidade_id'
+        ].tolist() if entidades_selecionadas else []
+
+        df_filtrado = tentar_carregar(
+            carregar_dados_completos,
+            min_matriculas, min_criterios, tuple(ids_selecionados) or None
+        )
+        if df_filtrado is None:
+            st.error("Não foi possível aplicar os filtros aos dados.")
+            st.stop()
+
         # Informar número de entidades após filtros
         st.sidebar.info(f"Exibindo {len(df_filtrado)} entidades após filtros")
         
         # Resumo das categorias específicas
         st.header("Resumo por Categoria")
-        
+
+        # Totais calculados direto no banco, com os mesmos filtros da interface
+        df_totais = tentar_carregar(carregar_totais, min_matriculas, min_criterios, ids_selecionados)
+        if df_totais is None:
+            st.error("Não foi possível carregar os totais para o resumo.")
+            st.stop()
+
+        # Converter a linha única para dict de uma vez, em vez de um
+        # lookup na Series por métrica
+        totais = df_totais.iloc[0].to_dict()
+
         col1, col2, col3 = st.columns(3)
-        
+
         with col1:
-            total_criterios = df_filtrado['total_criterios'].sum()
-            st.metric("Total de Critérios", int(total_criterios))
-            
-            total_formula = df_filtrado['formula_personalizada'].sum()
-            perc_formula = (total_formula / total_criterios * 100).round(1) if total_criterios > 0 else 0
-            st.metric("Com Fórmula Personalizada", f"{int(total_formula)} ({perc_formula}%)")
-            
-            total_grupo = df_filtrado['criterio_grupo'].sum()
-            perc_grupo = (total_grupo / total_criterios * 100).round(1) if total_criterios > 0 else 0
-            st.metric("Critérios de Grupo", f"{int(total_grupo)} ({perc_grupo}%)")
-        
+            total_criterios = int(totais['total_criterios'])
+            st.metric("Total de Critérios", total_criterios)
+
+            total_formula = int(totais['formula_personalizada'])
+            perc_formula = round(total_formula / total_criterios * 100, 1) if total_criterios > 0 else 0
+            st.metric("Com Fórmula Personalizada", f"{total_formula} ({perc_formula}%)")
+
+            total_grupo = int(totais['criterio_grupo'])
+            perc_grupo = round(total_grupo / total_criterios * 100, 1) if total_criterios > 0 else 0
+            st.metric("Critérios de Grupo", f"{total_grupo} ({perc_grupo}%)")
+
         with col2:
-            total_grupo_paralela = df_filtrado['grupo_rec_paralela'].sum()
-            perc_grupo_paralela = (total_grupo_paralela / total_grupo * 100).round(1) if total_grupo > 0 else 0
-            st.metric("Grupo com Rec. Paralela", f"{int(total_grupo_paralela)} ({perc_grupo_paralela}%)")
-            
-            total_grupo_semestral = df_filtrado['grupo_rec_semestral'].sum()
-            perc_grupo_semestral = (total_grupo_semestral / total_grupo * 100).round(1) if total_grupo > 0 else 0
-            st.metric("Grupo com Rec. Semestral", f"{int(total_grupo_semestral)} ({perc_grupo_semestral}%)")
-        
+            total_grupo_paralela = int(totais['grupo_rec_paralela'])
+            perc_grupo_paralela = round(total_grupo_paralela / total_grupo * 100, 1) if total_grupo > 0 else 0
+            st.metric("Grupo com Rec. Paralela", f"{total_grupo_paralela} ({perc_grupo_paralela}%)")
+
+            total_grupo_semestral = int(totais['grupo_rec_semestral'])
+            perc_grupo_semestral = round(total_grupo_semestral / total_grupo * 100, 1) if total_grupo > 0 else 0
+            st.metric("Grupo com Rec. Semestral", f"{total_grupo_semestral} ({perc_grupo_semestral}%)")
+
         with col3:
-            total_formula_paralela = df_filtrado['formula_rec_paralela'].sum()
-            perc_formula_paralela = (total_formula_paralela / total_formula * 100).round(1) if total_formula > 0 else 0
-            st.metric("Fórmula com Rec. Paralela", f"{int(total_formula_paralela)} ({perc_formula_paralela}%)")
-            
-            total_formula_semestral = df_filtrado['formula_rec_semestral'].sum()
-            perc_formula_semestral = (total_formula_semestral / total_formula * 100).round(1) if total_formula > 0 else 0
-            st.metric("Fórmula com Rec. Semestral", f"{int(total_formula_semestral)} ({perc_formula_semestral}%)")
-        
+            total_formula_paralela = int(totais['formula_rec_paralela'])
+            perc_formula_paralela = round(total_formula_paralela / total_formula * 100, 1) if total_formula > 0 else 0
+            st.metric("Fórmula com Rec. Paralela", f"{total_formula_paralela} ({perc_formula_paralela}%)")
+
+            total_formula_semestral = int(totais['formula_rec_semestral'])
+            perc_formula_semestral = round(total_formula_semestral / total_formula * 100, 1) if total_formula > 0 else 0
+            st.metric("Fórmula com Rec. Semestral", f"{total_formula_semestral} ({perc_formula_semestral}%)")
+
         # Resumo de matrículas
         col1, col2 = st.columns(2)
-        
+
         with col1:
-            total_matriculas = df_filtrado['total_matriculas'].sum()
-            st.metric("Total de Matrículas", f"{int(total_matriculas):,}".replace(",", "."))
-        
+            # st.metric não formata números; manter o separador de
+            # milhar deste único escalar em Python
+            total_matriculas = int(totais['total_matriculas'])
+            st.metric("Total de Matrículas", f"{total_matriculas:,}".replace(",", "."))
+
         with col2:
-            total_turmas = df_filtrado['total_turmas'].sum()
-            st.metric("Total de Turmas", int(total_turmas))
+            total_turmas = int(totais['total_turmas'])
+            st.metric("Total de Turmas", total_turmas)
         
         # Abas para diferentes análises
         tab1, tab2, tab3 = st.tabs(["Visão Geral", "Análise por Categoria", "Análise por Entidade"])
@@ -225,33 +450,9 @@ with st.spinner("Carregando dados detalhados..."):
         with tab1:
             st.header("Visão Geral dos Critérios")
             
-            # Criar dados para o gráfico de pizza das categorias
-            dados_pizza = {
-                'Categoria': [
-                    'Fórmula Personalizada com Rec. Paralela',
-                    'Fórmula Personalizada com Rec. Semestral',
-                    'Fórmula Personalizada (outros)',
-                    'Critério de Grupo com Rec. Paralela',
-                    'Critério de Grupo com Rec. Semestral',
-                    'Critério de Grupo (outros)',
-                    'Outros Critérios'
-                ],
-                'Quantidade': [
-                    total_formula_paralela,
-                    total_formula_semestral,
-                    total_formula - total_formula_paralela - total_formula_semestral,
-                    total_grupo_paralela,
-                    total_grupo_semestral,
-                    total_grupo - total_grupo_paralela - total_grupo_semestral,
-                    total_criterios - total_formula - total_grupo
-                ]
-            }
-            
-            df_pizza = pd.DataFrame(dados_pizza)
-            
-            # Remover categorias com zero
-            df_pizza = df_pizza[df_pizza['Quantidade'] > 0]
-            
+            # Dados do gráfico de pizza, derivados dos totais já agregados
+            df_pizza = montar_dados_pizza(totais)
+
             # Gráfico de pizza das categorias
             fig_pizza = px.pie(
                 df_pizza,
@@ -265,17 +466,21 @@ with st.spinner("Carregando dados detalhados..."):
             # Top entidades por matrículas
             st.subheader(f"Top {num_entidades} Entidades por Matrículas")
             
-            df_top_matriculas = df_filtrado.sort_values('total_matriculas', ascending=False).head(num_entidades)
-            
-            fig_matriculas = px.bar(
-                df_top_matriculas,
-                x='nome_entidade',
-                y='total_matriculas',
-                title=f'Top {num_entidades} Entidades por Número de Matrículas',
-                labels={'nome_entidade': 'Entidade', 'total_matriculas': 'Total de Matrículas'}
+            df_top_matriculas = tentar_carregar(
+                carregar_top_matriculas,
+                num_entidades, min_matriculas, min_criterios, tuple(ids_selecionados) or None
             )
-            fig_matriculas.update_layout(xaxis={'categoryorder':'total descending'})
-            st.plotly_chart(fig_matriculas, use_container_width=True)
+
+            if df_top_matriculas is not None:
+                fig_matriculas = px.bar(
+                    df_top_matriculas,
+                    x='nome_entidade',
+                    y='total_matriculas',
+                    title=f'Top {num_entidades} Entidades por Número de Matrículas',
+                    labels={'nome_entidade': 'Entidade', 'total_matriculas': 'Total de Matrículas'}
+                )
+                fig_matriculas.update_layout(xaxis={'categoryorder':'total descending'})
+                st.plotly_chart(fig_matriculas, use_container_width=True)
         
         with tab2:
             st.header("Análise por Categoria")
@@ -306,7 +511,7 @@ with st.spinner("Carregando dados detalhados..."):
             coluna_categoria = mapa_categorias[categoria_selecionada]
             
             # Top entidades para a categoria selecionada
-            df_top_categoria = df_filtrado.sort_values(coluna_categoria, ascending=False).head(num_entidades)
+            df_top_categoria = df_filtrado.nlargest(num_entidades, coluna_categoria)
             
             # Gráfico de barras para a categoria selecionada
             fig_categoria = px.bar(
@@ -327,6 +532,7 @@ with st.spinner("Carregando dados detalhados..."):
                 size='total_matriculas',
                 color='total_criterios',
                 hover_name='nome_entidade',
+                render_mode='webgl',
                 title=f'Relação entre {categoria_selecionada} e Matrículas',
                 labels={
                     coluna_categoria: f'Quantidade de {categoria_selecionada}',
@@ -353,9 +559,16 @@ with st.spinner("Carregando dados detalhados..."):
                 'total_matriculas': 'Total de Matrículas',
                 'total_turmas': 'Total de Turmas',
                 'percentual': f'% {categoria_selecionada}'
-            })
+            }, copy=False)
             
-            st.dataframe(df_display_cat, use_container_width=True)
+            st.dataframe(
+                df_display_cat,
+                use_container_width=True,
+                column_config={
+                    'Total de Matrículas': st.column_config.NumberColumn(format='%d'),
+                    f'% {categoria_selecionada}': st.column_config.NumberColumn(format='%.1f%%')
+                }
+            )
         
         with tab3:
             st.header("Análise por Entidade")
@@ -368,8 +581,11 @@ with st.spinner("Carregando dados detalhados..."):
                     index=0
                 )
             
-                # Filtrar para a entidade selecionada
-                df_entidade = df_filtrado[df_filtrado['nome_entidade'] == entidade_analise].iloc[0]
+                # Buscar a entidade selecionada pelo índice de nomes;
+                # loc[[...]].iloc[0] fica na primeira linha mesmo quando
+                # duas entidades compartilham o mesmo nome
+                df_indexado = indexar_por_nome(df_filtrado)
+                df_entidade = df_indexado.loc[[entidade_analise]].iloc[0]
                 
                 # Exibir métricas da entidade
                 col1, col2, col3 = st.columns(3)
@@ -399,35 +615,22 @@ with st.spinner("Carregando dados detalhados..."):
                     'Grupo c/ Rec. Semestral'
                 ]
                 
-                valores = [
-                    df_entidade['formula_personalizada'],
-                    df_entidade['formula_rec_paralela'],
-                    df_entidade['formula_rec_semestral'],
-                    df_entidade['criterio_grupo'],
-                    df_entidade['grupo_rec_paralela'],
-                    df_entidade['grupo_rec_semestral']
-                ]
-                
-                # Criar gráfico de radar
-                fig_radar = go.Figure()
-                
-                fig_radar.add_trace(go.Scatterpolar(
-                    r=valores,
-                    theta=categorias,
-                    fill='toself',
-                    name=entidade_analise
-                ))
-                
-                fig_radar.update_layout(
-                    polar=dict(
-                        radialaxis=dict(
-                            visible=True,
-                            range=[0, max(valores) * 1.1]
-                        )
-                    ),
-                    title=f"Perfil de Critérios Avaliativos de {entidade_analise}"
+                # Buscar os seis valores de uma vez como array numpy,
+                # a partir da linha já carregada
+                valores = df_entidade[[
+                    'formula_personalizada',
+                    'formula_rec_paralela',
+                    'formula_rec_semestral',
+                    'criterio_grupo',
+                    'grupo_rec_paralela',
+                    'grupo_rec_semestral'
+                ]].to_numpy()
+
+                # Criar gráfico de radar (cacheado por entidade e valores)
+                fig_radar = montar_radar(
+                    entidade_analise, categorias, tuple(int(v) for v in valores)
                 )
-                
+
                 st.plotly_chart(fig_radar, use_container_width=True)
                 
                 # Gráfico de barras comparando as categorias
@@ -451,9 +654,16 @@ with st.spinner("Carregando dados detalhados..."):
         # Tabela completa com todas as categorias
         st.header("Tabela Completa de Critérios Avaliativos")
         
-        # Preparar para exibição
-        df_display = df_filtrado.copy()
-        df_display = df_display.rename(columns={
+        # Preparar para exibição: selecionar as colunas (já exclui o ID)
+        # e renomear sem copiar os dados
+        colunas_exibicao = [
+            'nome_entidade', 'total_criterios', 'formula_personalizada',
+            'criterio_grupo', 'grupo_rec_paralela', 'grupo_rec_semestral',
+            'formula_rec_paralela', 'formula_rec_semestral',
+            'total_matriculas', 'total_turmas',
+            'percentual_formula', 'percentual_grupo'
+        ]
+        df_display = df_filtrado[colunas_exibicao].rename(columns={
             'nome_entidade': 'Entidade',
             'total_criterios': 'Total de Critérios',
             'formula_personalizada': 'Fórmula Personalizada',
@@ -463,11 +673,10 @@ with st.spinner("Carregando dados detalhados..."):
             'formula_rec_paralela': 'Fórmula com Rec. Paralela',
             'formula_rec_semestral': 'Fórmula com Rec. Semestral',
             'total_matriculas': 'Total de Matrículas',
-            'total_turmas': 'Total de Turmas'
-        })
-        
-        # Remover coluna de ID para exibição
-        df_display = df_display.drop(columns=['entidade_id'])
+            'total_turmas': 'Total de Turmas',
+            'percentual_formula': '% Fórmula Personalizada',
+            'percentual_grupo': '% Critérios de Grupo'
+        }, copy=False)
         
         # Opções de ordenação
         opcoes_ordenacao = {
@@ -486,11 +695,19 @@ with st.spinner("Carregando dados detalhados..."):
         # Aplicar ordenação
         df_display = df_display.sort_values(opcoes_ordenacao[coluna_ordenacao], ascending=False)
         
-        # Exibir tabela
-        st.dataframe(df_display, use_container_width=True)
+        # Exibir tabela (formatação numérica feita no frontend)
+        st.dataframe(
+            df_display,
+            use_container_width=True,
+            column_config={
+                'Total de Matrículas': st.column_config.NumberColumn(format='%d'),
+                '% Fórmula Personalizada': st.column_config.NumberColumn(format='%.1f%%'),
+                '% Critérios de Grupo': st.column_config.NumberColumn(format='%.1f%%')
+            }
+        )
         
         # Botão para download dos dados
-        csv = df_display.to_csv(index=False).encode('utf-8')
+        csv = to_csv_bytes(df_display)
         st.download_button(
             label="Download dos dados como CSV",
             data=csv,